@@ -17,6 +17,7 @@ If mode=sentinel, script reads until sentinel appears, excluding sentinel.
 
 Image serialization:
 - For typical 24-bit RGB images, bytes = PIL Image converted to RGB then .tobytes().
+- With in_grayscale=True the image is converted to 8-bit "L" instead (1 byte/pixel).
 - The hardware design expects a stream of bytes; adapt preprocessing if needed
   (e.g., resize to 128x128). Use --in-width/--in-height to enforce resize.
 
@@ -25,7 +26,7 @@ Output image reconstruction:
   reconstruct an 8-bit image from received bytes. Otherwise we just store raw bytes
   in an image with original size (or fallback raw dump if sizes mismatch).
 
-CSV log per input image: <image_base>.csv with columns:
+CSV log per input image: <image_base>.csv (or one combined_csv file) with columns:
   id,input_name,bytes_sent,bytes_received,duration_s,output_image_path,mode,success,timestamp
 
 Requirements: pyserial, Pillow
@@ -34,9 +35,14 @@ Install: pip install -r requirements.txt
 from __future__ import annotations
 from types import SimpleNamespace
 import csv
+import hashlib
 import logging
+import os
+import struct
 import sys
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
@@ -54,15 +60,46 @@ DEFAULT_PORT = "COM4"
 SENTINEL_DEFAULT = b"/0/0"  # adjustable
 START_BYTE = 0x5A
 RESP_BYTE = 0xA5
+HEADER = struct.Struct("<BI")  # start/response byte + 4-byte little-endian length
+IMAGE_EXTS = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}
+RESAMPLE_FILTERS = ('nearest', 'box', 'bilinear', 'hamming', 'bicubic', 'lanczos')
+# Bump whenever load_image_bytes can produce different bytes for the same inputs,
+# so payloads cached by an older pipeline are never reused.
+PAYLOAD_CACHE_VERSION = 2
+PAYLOAD_CACHE_TMP_MAX_AGE_S = 3600
 
 logger = logging.getLogger("uart_image_sender")
 
 class UartImageSender:
-    def __init__(self, port: str, baud: int, timeout: float):
+    def __init__(self, port: str, baud: int, timeout: float, rtscts: bool = False):
         if serial is None:
             raise RuntimeError("pyserial not installed. Run: pip install pyserial")
-        self.ser = serial.Serial(port=port, baudrate=baud, timeout=timeout)
+        self.ser = serial.Serial(port=port, baudrate=baud, timeout=timeout, rtscts=rtscts)
         logger.info("Opened %s @ %d baud", port, baud)
+        self._enable_low_latency()
+        self._enlarge_buffers()
+
+    def _enlarge_buffers(self):
+        # Windows drivers default to a 4 KB RX queue, smaller than one RGB frame; the
+        # method only exists on the Windows backend (POSIX kernel buffers are fixed).
+        if not hasattr(self.ser, "set_buffer_size"):
+            return
+        try:
+            self.ser.set_buffer_size(rx_size=1 << 20, tx_size=1 << 18)
+        except (OSError, ValueError) as e:
+            logger.debug("Could not resize driver buffers: %s", e)
+
+    def _enable_low_latency(self):
+        # USB-serial bridges (FTDI) batch RX data behind a 16 ms latency timer by default.
+        # pyserial only implements ASYNC_LOW_LATENCY on Linux; the other POSIX backends
+        # define set_low_latency_mode but raise NotImplementedError, and Windows lacks it.
+        if not sys.platform.startswith("linux") or not hasattr(self.ser, "set_low_latency_mode"):
+            return
+        try:
+            self.ser.set_low_latency_mode(True)
+            logger.debug("Enabled low-latency mode")
+        except (OSError, ValueError, NotImplementedError) as e:
+            logger.debug("Low-latency mode not supported on this port: %s", e)
 
     def close(self):
         if self.ser and self.ser.is_open:
@@ -76,32 +113,34 @@ class UartImageSender:
         bytes (if provided) or whatever arrives before timeout.
         """
         length = len(payload)
-        header = bytes([START_BYTE]) + length.to_bytes(4, "little")
-        self.ser.write(header + payload)
+        header = HEADER.pack(START_BYTE, length)
+        # two writes rather than header + payload, which would copy the whole image
+        self.ser.write(header)
+        self.ser.write(payload)
         self.ser.flush()
         logger.debug("Sent header+payload (%d bytes)", length)
         # Wait for response header (or fallback to raw)
-        start_time = time.time()
+        start_time = time.perf_counter()
         self.ser.timeout = read_timeout
-        hdr = self.ser.read(5)
+        hdr = self.ser.read(HEADER.size)
         # If we got a proper header from device, use its length
-        if len(hdr) >= 5 and hdr[0] == RESP_BYTE:
-            resp_len = int.from_bytes(hdr[1:5], "little")
-            data = bytearray()
+        if len(hdr) == HEADER.size and hdr[0] == RESP_BYTE:
+            _, resp_len = HEADER.unpack(hdr)
+            # read_timeout bounds each read, not the whole body: keep reading while bytes still arrive.
+            # A read only comes back short after a full timeout, so the top-up concatenation is rare.
+            data = self.ser.read(resp_len)
             while len(data) < resp_len:
                 chunk = self.ser.read(resp_len - len(data))
                 if not chunk:
                     raise TimeoutError("Timed out receiving response payload")
-                data.extend(chunk)
+                data += chunk
             logger.debug("Received response (%d bytes)", resp_len)
-            logger.info("Transfer complete in %.3fs", time.time() - start_time)
-            return bytes(data)
+            logger.info("Transfer complete in %.3fs", time.perf_counter() - start_time)
+            return data
 
         # Fallback: device did not send RESP header (common when FPGA streams raw bytes)
         # Treat any bytes already read (hdr) as part of the payload and continue
-        data = bytearray()
-        if hdr:
-            data.extend(hdr)
+        data = bytearray(hdr)
 
         # If expected_len provided, read until that many bytes collected
         if expected_len is not None and expected_len > 0:
@@ -113,53 +152,144 @@ class UartImageSender:
                     break
                 data.extend(chunk)
             logger.debug("Fallback: collected %d bytes (expected %d)", len(data), expected_len)
-            logger.info("Transfer (fallback) complete in %.3fs", time.time() - start_time)
+            logger.info("Transfer (fallback) complete in %.3fs", time.perf_counter() - start_time)
             return bytes(data)
 
-        # No expected length: read until timeout and return whatever arrived
+        # No expected length: read until timeout and return whatever arrived.
+        # Drain everything buffered per call; read(1) only blocks (as the idle detector) when empty.
         while True:
-            chunk = self.ser.read(1024)
+            chunk = self.ser.read(self.ser.in_waiting or 1)
             if not chunk:
                 break
             data.extend(chunk)
         logger.debug("Fallback: collected %d bytes (no expected length)", len(data))
-        logger.info("Transfer (fallback) complete in %.3fs", time.time() - start_time)
+        logger.info("Transfer (fallback) complete in %.3fs", time.perf_counter() - start_time)
         return bytes(data)
 
     def send_with_sentinel(self, payload: bytes, sentinel: bytes, read_timeout: float) -> bytes:
         self.ser.write(payload)
         self.ser.flush()
         logger.debug("Sent payload (%d bytes) sentinel mode", len(payload))
-        start_time = time.time()
+        start_time = time.perf_counter()
         self.ser.timeout = read_timeout
         data = bytearray()
-        window = bytearray()
+        search_from = 0
         while True:
-            b = self.ser.read(1)
-            if not b:
+            # drain whatever is buffered; read(1) blocks up to the timeout when idle
+            chunk = self.ser.read(self.ser.in_waiting or 1)
+            if not chunk:
                 raise TimeoutError("Timed out waiting for sentinel in response")
-            data.extend(b)
-            window.extend(b)
-            if len(window) > len(sentinel):
-                # keep window length bounded
-                del window[0:len(window) - len(sentinel)]
-            if bytes(window) == sentinel:
-                data = data[:-len(sentinel)]  # remove sentinel
+            data.extend(chunk)
+            idx = data.find(sentinel, search_from)
+            if idx >= 0:
+                if len(data) > idx + len(sentinel):
+                    logger.debug("Discarding %d bytes after sentinel", len(data) - idx - len(sentinel))
+                del data[idx:]  # remove sentinel
                 break
+            # only rescan the tail that could hold a sentinel split across chunks
+            search_from = max(0, len(data) - len(sentinel) + 1)
         logger.debug("Received response (%d bytes before sentinel)", len(data))
-        logger.info("Transfer complete in %.3fs", time.time() - start_time)
+        logger.info("Transfer complete in %.3fs", time.perf_counter() - start_time)
         return bytes(data)
 
 
-def load_image_bytes(path: Path, in_width: Optional[int], in_height: Optional[int]) -> bytes:
+def load_image_bytes(path: Path, in_width: Optional[int], in_height: Optional[int], grayscale: bool = False,
+                     resample: str = "bilinear") -> bytes:
     if Image is None:
         raise RuntimeError("Pillow not installed. Run: pip install Pillow")
-    img = Image.open(path).convert("RGB")
+    # Convert before resizing so a grayscale resize only touches one channel
+    mode = "L" if grayscale else "RGB"
+    img = Image.open(path)
     if in_width and in_height:
-        img = img.resize((in_width, in_height), Image.Resampling.LANCZOS)
+        # JPEG only: let libjpeg decode at a reduced DCT scale that is still >= the target size
+        img.draft(mode, (in_width, in_height))
+    if img.mode != mode:
+        img = img.convert(mode)
+    if in_width and in_height and img.size != (in_width, in_height):
+        img = img.resize((in_width, in_height), Image.Resampling[resample.upper()])
     return img.tobytes()
 
 
+def load_image_bytes_cached(path: Path, in_width: Optional[int], in_height: Optional[int], grayscale: bool = False,
+                            resample: str = "bilinear", cache_dir: Optional[Path] = None) -> bytes:
+    """
+    load_image_bytes with an on-disk cache of the prepared payload. Entries are keyed on
+    the source path, mtime and size, the preprocessing settings, PAYLOAD_CACHE_VERSION
+    and the Pillow version, so editing an image, changing settings or upgrading the
+    pipeline simply misses the cache.
+    """
+    if cache_dir is None:
+        return load_image_bytes(path, in_width, in_height, grayscale, resample)
+    st = path.stat()
+    pil_version = getattr(Image, "__version__", "")
+    key = (f"v{PAYLOAD_CACHE_VERSION}|pil{pil_version}|{path.resolve()}|{st.st_mtime_ns}|{st.st_size}|"
+           f"{in_width}x{in_height}|{'L' if grayscale else 'RGB'}|{resample}")
+    cache_path = Path(cache_dir) / f"{hashlib.sha1(key.encode()).hexdigest()}.bin"
+    try:
+        payload = cache_path.read_bytes()
+    except OSError:
+        pass
+    else:
+        try:
+            os.utime(cache_path)  # mtime doubles as last-use time for prune_payload_cache
+        except OSError:
+            pass  # read-only or shared cache: still a hit, it just won't look recently used
+        logger.debug("Payload cache hit for %s", path.name)
+        return payload
+    payload = load_image_bytes(path, in_width, in_height, grayscale, resample)
+    tmp_name = None
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # unique temp file + rename: concurrent runs never share a temp path and an
+        # interrupted write never leaves a truncated entry
+        with tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix=".tmp", delete=False) as tmp:
+            tmp_name = tmp.name
+            tmp.write(payload)
+        os.replace(tmp_name, cache_path)
+    except OSError as e:
+        logger.warning("Could not write payload cache %s: %s", cache_path, e)
+        if tmp_name is not None:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+    return payload
+
+
+def prune_payload_cache(cache_dir: Path, max_bytes: int) -> None:
+    """
+    Delete least recently used cache entries until the cache fits in max_bytes. Temp files
+    left behind by a killed run are removed once they are older than PAYLOAD_CACHE_TMP_MAX_AGE_S
+    (younger ones may still belong to a concurrent run).
+    """
+    entries = []
+    stale_before = time.time() - PAYLOAD_CACHE_TMP_MAX_AGE_S
+    try:
+        with os.scandir(cache_dir) as it:
+            for e in it:
+                if not e.is_file():
+                    continue
+                st = e.stat()
+                if e.name.endswith(".bin"):
+                    entries.append((st.st_mtime, st.st_size, e.path))
+                elif e.name.endswith(".tmp") and st.st_mtime < stale_before:
+                    try:
+                        os.unlink(e.path)
+                    except OSError as err:
+                        logger.debug("Could not remove stale temp file %s: %s", e.path, err)
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(entry_path)
+            total -= size
+        except OSError as e:
+            logger.debug("Could not evict %s: %s", entry_path, e)
+
+
 def reconstruct_output_image(data: bytes, out_path: Path, out_width: Optional[int], out_height: Optional[int], original_ext: str) -> None:
     if Image is None:
         # dump raw bytes if Pillow missing
@@ -169,21 +299,51 @@ def reconstruct_output_image(data: bytes, out_path: Path, out_width: Optional[in
         expected = out_width * out_height
         # Assume grayscale single byte per pixel
         if len(data) == expected:
-            img = Image.frombytes("L", (out_width, out_height), data)
-            img.save(out_path)
+            # frombuffer wraps `data` rather than copying it; it stays alive until save() returns
+            img = Image.frombuffer("L", (out_width, out_height), data, "raw", "L", 0, 1)
+            # fast zlib level for PNG outputs; other formats ignore it
+            img.save(out_path, compress_level=1)
             return
     # Fallback: try original RGB size guess if length matches
     # Not robust; user may adapt.
     out_path.write_bytes(data)
 
 
-def write_csv(csv_path: Path, row: dict) -> None:
-    write_header = not csv_path.exists()
-    with csv_path.open("a", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=row.keys())
+class CsvLog:
+    """
+    Appends rows to the run's CSV logs. Per-image <stem>.csv files get one row per run,
+    so they are opened and closed around each row. The shared combined_csv file, if
+    any, is opened once and flushed after every row.
+    """
+    def __init__(self, shared_path: Optional[Path] = None):
+        self.shared_path = shared_path
+        self._shared = None
+
+    @staticmethod
+    def _open(csv_path: Path, fieldnames):
+        write_header = not csv_path.exists()
+        f = csv_path.open("a", newline="")
+        w = csv.DictWriter(f, fieldnames=fieldnames)
         if write_header:
             w.writeheader()
+        return f, w
+
+    def write(self, csv_path: Path, row: dict) -> None:
+        if csv_path != self.shared_path:
+            f, w = self._open(csv_path, row.keys())
+            with f:
+                w.writerow(row)
+            return
+        if self._shared is None:
+            self._shared = self._open(csv_path, row.keys())
+        f, w = self._shared
         w.writerow(row)
+        f.flush()
+
+    def close(self):
+        if self._shared is not None:
+            self._shared[0].close()
+            self._shared = None
 
 
 def process_folder(args):
@@ -193,19 +353,96 @@ def process_folder(args):
     out_img_dir.mkdir(parents=True, exist_ok=True)
     out_csv_dir.mkdir(parents=True, exist_ok=True)
 
-    images = sorted([p for p in input_dir.iterdir() if p.is_file() and p.suffix.lower() in {'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}])
+    # scandir's DirEntry.is_file() uses the d_type from the listing, so no stat() per entry
+    with os.scandir(input_dir) as it:
+        images = sorted(Path(e.path) for e in it if e.is_file() and os.path.splitext(e.name)[1].lower() in IMAGE_EXTS)
     if not images:
         logger.error("No images found in %s", input_dir)
         return 1
 
-    sender = UartImageSender(args.port, args.baud, args.timeout)
-    start_global = time.time()
+    resample = str(getattr(args, 'resample', 'bilinear')).lower()
+    if resample not in RESAMPLE_FILTERS:
+        logger.error("Unknown resample filter %r; expected one of: %s", args.resample, ", ".join(RESAMPLE_FILTERS))
+        return 1
+
+    cache_dir = getattr(args, 'payload_cache_dir', None)
+    cache_max_bytes = int(getattr(args, 'payload_cache_max_mb', 256)) << 20
+    if cache_dir is not None:
+        prune_payload_cache(Path(cache_dir), cache_max_bytes)
+
+    def load(path):
+        return load_image_bytes_cached(path, args.in_width, args.in_height, getattr(args, 'in_grayscale', False),
+                                       resample, getattr(args, 'payload_cache_dir', None))
+
+    combined_csv = getattr(args, 'combined_csv', None)
+    csv_log = CsvLog(out_csv_dir / combined_csv if combined_csv else None)
+
+    def log_row(idx, img_path, bytes_sent, bytes_received, duration_s, out_img_path, success):
+        try:
+            csv_log.write(out_csv_dir / (combined_csv or f"{img_path.stem}.csv"), {
+                'id': idx,
+                'input_name': img_path.name,
+                'bytes_sent': bytes_sent,
+                'bytes_received': bytes_received,
+                'duration_s': duration_s,
+                'output_image_path': out_img_path,
+                'mode': args.mode,
+                'success': success,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+            })
+        except Exception as e:
+            logger.error("Could not write CSV row for %s: %s", img_path.name, e)
+            return False
+        return True
+
+    def save_output(idx, img_path, bytes_sent, resp, duration_s):
+        # Runs on the writer thread so image encoding/disk I/O overlaps the next transfer
+        base = img_path.stem
+        out_img_name = f"{base}_{idx}{img_path.suffix}" if img_path.suffix else f"{base}_{idx}.bin"
+        out_img_path = out_img_dir / out_img_name
+        try:
+            reconstruct_output_image(resp, out_img_path, args.out_width, args.out_height, img_path.suffix)
+        except Exception as e:
+            log_row(idx, img_path, bytes_sent, len(resp), duration_s, '', False)
+            logger.error("Failed %s: could not save output: %s", img_path.name, e)
+            return False
+        if not log_row(idx, img_path, bytes_sent, len(resp), duration_s, str(out_img_path), True):
+            return False
+        logger.info("Processed %s -> %s", img_path.name, out_img_name)
+        return True
+
+    sender = UartImageSender(args.port, args.baud, args.timeout, getattr(args, 'rtscts', False))
+    # Decode/resize the next image on a worker thread while the current one is on the wire.
+    # Pillow releases the GIL while decoding, so this overlaps with the blocking serial reads.
+    prefetch = ThreadPoolExecutor(max_workers=1)
+    pending = prefetch.submit(load, images[0])
+    # All output files and CSV rows go through one writer thread, which keeps them ordered
+    # and leaves CsvLog single-threaded.
+    writer = ThreadPoolExecutor(max_workers=1)
+    saves = []
+    failure_rows = []
+
+    def writer_ok(f):
+        # Blocks until the writer task has run; an unexpected exception counts as a failure
+        try:
+            return bool(f.result())
+        except Exception as e:
+            logger.error("Writer task failed: %s", e)
+            return False
+    start_global = time.perf_counter()
     success_count = 0
     try:
         for idx, img_path in enumerate(images, start=1):
-            t0 = time.time()
+            # With stop_on_error, wait for the previous save so a failed write stops the run
+            # before the next image goes out; otherwise saves keep overlapping the transfers.
+            if args.stop_on_error and saves and not writer_ok(saves[-1]):
+                break
+            t0 = time.perf_counter()
+            payload = None
+            current = pending
+            pending = prefetch.submit(load, images[idx]) if idx < len(images) else None
             try:
-                payload = load_image_bytes(img_path, args.in_width, args.in_height)
+                payload = current.result()
                 if args.mode == 'length':
                     expected = None
                     if getattr(args, 'out_width', None) and getattr(args, 'out_height', None):
@@ -213,25 +450,7 @@ def process_folder(args):
                     resp = sender.send_with_length(payload, args.read_timeout, expected_len=expected)
                 else:
                     resp = sender.send_with_sentinel(payload, args.sentinel, args.read_timeout)
-                # Prepare output naming
-                base = img_path.stem
-                out_img_name = f"{base}_{idx}{img_path.suffix}" if img_path.suffix else f"{base}_{idx}.bin"
-                out_img_path = out_img_dir / out_img_name
-                reconstruct_output_image(resp, out_img_path, args.out_width, args.out_height, img_path.suffix)
-                csv_path = out_csv_dir / f"{base}.csv"
-                write_csv(csv_path, {
-                    'id': idx,
-                    'input_name': img_path.name,
-                    'bytes_sent': len(payload),
-                    'bytes_received': len(resp),
-                    'duration_s': round(time.time() - t0, 6),
-                    'output_image_path': str(out_img_path),
-                    'mode': args.mode,
-                    'success': True,
-                    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
-                })
-                success_count += 1
-                logger.info("Processed %s -> %s", img_path.name, out_img_name)
+                saves.append(writer.submit(save_output, idx, img_path, len(payload), resp, round(time.perf_counter() - t0, 6)))
             except Exception as e:
                 # Attempt to read any bytes that may have been received from device
                 bytes_received = 0
@@ -249,24 +468,26 @@ def process_folder(args):
                 except Exception:
                     bytes_received = 0
 
-                csv_path = out_csv_dir / f"{img_path.stem}.csv"
-                write_csv(csv_path, {
-                    'id': idx,
-                    'input_name': img_path.name,
-                    'bytes_sent': len(payload) if 'payload' in locals() else 0,
-                    'bytes_received': bytes_received,
-                    'duration_s': round(time.time() - t0, 6),
-                    'output_image_path': '',
-                    'mode': args.mode,
-                    'success': False,
-                    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
-                })
+                failure_rows.append(writer.submit(log_row, idx, img_path, len(payload) if payload is not None else 0,
+                                                   bytes_received, round(time.perf_counter() - t0, 6), '', False))
                 logger.error("Failed %s: %s (bytes_received=%d)", img_path.name, e, bytes_received)
                 if args.stop_on_error:
                     break
-        logger.info("Completed %d/%d images in %.2fs", success_count, len(images), time.time() - start_global)
+        writer.shutdown(wait=True)
+        for f in failure_rows:
+            writer_ok(f)
+        success_count = sum(1 for f in saves if writer_ok(f))
+        logger.info("Completed %d/%d images in %.2fs", success_count, len(images), time.perf_counter() - start_global)
     finally:
+        if pending is not None:
+            pending.cancel()
+        prefetch.shutdown(wait=True)
+        writer.shutdown(wait=True)
+        csv_log.close()
         sender.close()
+        if cache_dir is not None:
+            # the run itself adds entries, so trim again once the prefetch thread has stopped
+            prune_payload_cache(Path(cache_dir), cache_max_bytes)
     return 0 if success_count == len(images) else 2
 
 
@@ -280,14 +501,20 @@ def get_hardcoded_args():
         port=DEFAULT_PORT,
         baud=DEFAULT_BAUD,
         timeout=2.0,
+        rtscts=False,                  # hardware flow control (FPGA design must drive CTS)
         read_timeout=10.0,
         mode='length',                 # 'length' or 'sentinel'
         sentinel=SENTINEL_DEFAULT,
         in_width=128,                  # resize inputs to this (or None)
         in_height=128,
+        in_grayscale=False,            # send 1 byte/pixel instead of RGB
+        resample='bilinear',           # resize filter, one of RESAMPLE_FILTERS
+        payload_cache_dir=None,        # e.g. '.payload_cache' to reuse preprocessed payloads across runs
+        payload_cache_max_mb=256,      # evict least recently used entries beyond this size
         out_width=64,                  # expected output image size for reconstruction
         out_height=64,
         stop_on_error=False,
+        combined_csv=None,             # e.g. 'results.csv' to log every image to one file
         log_level='INFO'
     )
 